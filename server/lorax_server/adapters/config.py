@@ -8,6 +8,7 @@ from lorax_server.adapters.weights import AdapterWeights
 
 if TYPE_CHECKING:
     from lorax_server.models.model import Model
+    from lorax_server.utils.sources.source import BaseModelSource
 
 
 ModuleMap = Dict[str, Dict[str, Tuple[torch.Tensor, str]]]
@@ -35,3 +36,7 @@ class AdapterConfig(ABC):
         dynamic: bool,
     ) -> Optional[AdapterWeights]:
         pass
+
+    def get_resident_bytes(self, source: "BaseModelSource") -> int:
+        """Returns the device memory taken by the adapter weights downloaded from `source` once they are loaded."""
+        return source.get_weight_bytes()
@@ -1,7 +1,9 @@
-from collections import defaultdict
+import weakref
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple, Type, Union
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set, Tuple, Type, Union
 
+import numpy as np
 import torch
 from peft import LoraConfig as _LoraConfig
 from torch.distributed import ProcessGroup
@@ -12,18 +14,33 @@ from lorax_server.adapters.weights import AdapterBatchMetadata, AdapterWeights,
 from lorax_server.utils.lora import LM_HEAD
 from lorax_server.utils.punica import (
     BGMV_MAX_RANK,
+    LORA_RESIDENT_SIZE_FACTOR,
+    LORAX_COMPILE_LORA_META,
+    LORAX_LORA_INT8_CACHE,
     MAX_RANK_CUSTOM,
+    MIN_RANK_CUSTOM,
     get_tmp_tensors,
-    orient_for_rank,
     pad_rank,
+    pad_to_min_rank,
     use_cutlass_shrink,
 )
 from lorax_server.utils.weights import load_module_weight
 
 if TYPE_CHECKING:
     from lorax_server.models.model import Model
+    from lorax_server.utils.sources.source import BaseModelSource
 
-EMPTY_TENSOR = torch.tensor([])
+
+# byte alignment of each of the weights packed into the buffer of an adapter
+WEIGHTS_ALIGNMENT = 256
+
+# number of batches whose pointer arrays can be staged before the buffers are reused, and int64 entries per batch
+PTR_STAGING_RING_SIZE = 4
+PTR_STAGING_CAPACITY = 16 * 1024
+
+
+def is_lora_weight(weight_name: str) -> bool:
+    return ".lora_A." in weight_name or ".lora_B." in weight_name
 
 
 @dataclass
@@ -40,19 +57,24 @@ class LoraConfig(AdapterConfig):
         weight_names: Tuple[str],
     ) -> Tuple[ModuleMap, Set[str]]:
         adapter_weight_names = set()
+        add_weight_name = adapter_weight_names.add
+        get_adapter_weight = adapter_weights.get
         module_map = {}
+        prefix = "base_model.model."
         for weight_name in weight_names:
-            lora_a_name = f"base_model.model.{weight_name}.lora_A.weight"
-            lora_b_name = f"base_model.model.{weight_name}.lora_B.weight"
-            if lora_a_name not in adapter_weights or lora_b_name not in adapter_weights:
+            lora_a_name = prefix + weight_name + ".lora_A.weight"
+            lora_b_name = prefix + weight_name + ".lora_B.weight"
+            lora_a = get_adapter_weight(lora_a_name)
+            lora_b = get_adapter_weight(lora_b_name)
+            if lora_a is None or lora_b is None:
                 continue
 
             module_map[weight_name] = {
-                "lora_A": (adapter_weights[lora_a_name], lora_a_name),
-                "lora_B": (adapter_weights[lora_b_name], lora_b_name),
+                "lora_A": (lora_a, lora_a_name),
+                "lora_B": (lora_b, lora_b_name),
             }
-            adapter_weight_names.add(lora_a_name)
-            adapter_weight_names.add(lora_b_name)
+            add_weight_name(lora_a_name)
+            add_weight_name(lora_b_name)
         return module_map, adapter_weight_names
 
     def load_batched_adapter_weights(
@@ -71,6 +93,10 @@ class LoraConfig(AdapterConfig):
             unused_weight_names,
         )
 
+    def get_resident_bytes(self, source: "BaseModelSource") -> int:
+        # loaded weights are kept in more than one layout, so they take more memory than the downloaded files
+        return int(source.get_weight_bytes() * LORA_RESIDENT_SIZE_FACTOR)
+
     @classmethod
     def load(cls, adapter_id: str, api_token: str) -> "LoraConfig":
         hf_config = _LoraConfig.from_pretrained(adapter_id, token=api_token)
@@ -97,47 +123,96 @@ class LoraWeights(AdapterWeights):
         self.lora_b_r = weights_b[0].size(0) if len(weights_a) > 0 else 1
 
         self._use_cutlass_shrink = use_cutlass_shrink(self.lora_a_r)
-        self._is_transposed = False
 
         # [num_layers, hidden_size, r]
-        weights_a = [orient_for_rank(w, w.size(1)).contiguous() for w in weights_a]
-        self._weights_a = torch.stack(weights_a)
+        stacked_a = torch.stack(weights_a)
+        if MIN_RANK_CUSTOM <= self.lora_a_r <= MAX_RANK_CUSTOM:
+            # same orientation as `orient_for_rank`, but done in one copy over all the stacked layers
+            stacked_a = stacked_a.transpose(1, 2)
 
         # [num_layers, r, hidden_size]
-        self._weights_b = torch.stack(weights_b)
+        stacked_b = torch.stack(weights_b)
+
+        # SGMV (prefill) and BGMV (decode) expect different orientations, so keep both around
+        # instead of transposing the weights every time the batch switches between the two.
+        # All of them are views into a single buffer, so the adapter can be moved with one copy.
+        stacked_a_t = stacked_a.transpose(1, 2) if self._use_cutlass_shrink else stacked_a
+        stacked_b_t = stacked_b.transpose(1, 2)
+        stacked = [stacked_a, stacked_b]
+        if self._use_cutlass_shrink:
+            stacked.append(stacked_a_t)
+        stacked.append(stacked_b_t)
+
+        # int8 copies of the BGMV (decode) weights with one scale per rank, only stored for now
+        if LORAX_LORA_INT8_CACHE:
+            a_hidden_dim = 1 if stacked_a_t.size(1) != self.lora_a_r else 2
+            stacked.extend(_quantize_int8(stacked_a_t, dim=a_hidden_dim))
+            stacked.extend(_quantize_int8(stacked_b_t, dim=1))
+
+        self._buffer, views = _alloc_packed(stacked)
+        self._weights_a, self._weights_b, *views = views
+        if self._use_cutlass_shrink:
+            self._weights_a_t, *views = views
+        else:
+            # If we're not using the cutlass shrink, then both SGMV and BGMV use the same orientation
+            self._weights_a_t = self._weights_a
+        self._weights_b_t, *views = views
+
+        self._weights_a_q8 = self._weights_a_scale = None
+        self._weights_b_q8 = self._weights_b_scale = None
+        if LORAX_LORA_INT8_CACHE:
+            self._weights_a_q8, self._weights_a_scale, self._weights_b_q8, self._weights_b_scale = views
+
+        self.device = self._weights_a.device
+
+        # cache the raw pointers passed to the kernels so batching doesn't need to query them
+        self.weights_a_ptr = self._weights_a.data_ptr()
+        self.weights_b_ptr = self._weights_b.data_ptr()
+        self.weights_a_t_ptr = self._weights_a_t.data_ptr()
+        self.weights_b_t_ptr = self._weights_b_t.data_ptr()
+        self._singleton_ptrs: Dict[bool, Tuple[torch.Tensor, torch.Tensor]] = {}
 
         self.adapter_config = adapter_config
 
     @property
     def weights_a(self) -> torch.Tensor:
-        if self._is_transposed:
-            self._transpose_weights()
         return self._weights_a
 
     @property
     def weights_b(self) -> torch.Tensor:
-        if self._is_transposed:
-            self._transpose_weights()
         return self._weights_b
 
     @property
     def weights_a_t(self) -> torch.Tensor:
-        if not self._is_transposed:
-            self._transpose_weights()
-        return self._weights_a
+        return self._weights_a_t
 
     @property
     def weights_b_t(self) -> torch.Tensor:
-        if not self._is_transposed:
-            self._transpose_weights()
-        return self._weights_b
+        return self._weights_b_t
 
-    def _transpose_weights(self):
-        if self._use_cutlass_shrink:
-            # If we're not using the cutlass shrink, then both SGMV and BGMV use the same orientation
-            self._weights_a = self._weights_a.transpose(1, 2).contiguous()
-        self._weights_b = self._weights_b.transpose(1, 2).contiguous()
-        self._is_transposed = not self._is_transposed
+    @property
+    def weights_a_q8(self) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        if self._weights_a_q8 is None:
+            return None
+        return self._weights_a_q8, self._weights_a_scale
+
+    @property
+    def weights_b_q8(self) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        if self._weights_b_q8 is None:
+            return None
+        return self._weights_b_q8, self._weights_b_scale
+
+    def singleton_ptrs(self, use_sgmv: bool) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the pointer arrays of a batch with this adapter as the only segment, moved to the device once."""
+        ptrs = self._singleton_ptrs.get(use_sgmv)
+        if ptrs is None:
+            if use_sgmv:
+                ptr_a, ptr_b = self.weights_a_ptr, self.weights_b_ptr
+            else:
+                ptr_a, ptr_b = self.weights_a_t_ptr, self.weights_b_t_ptr
+            ptrs = torch.tensor([ptr_a, ptr_b], dtype=torch.int64, device=self.device).chunk(2)
+            self._singleton_ptrs[use_sgmv] = ptrs
+        return ptrs
 
     @classmethod
     def get_batch_types(cls) -> List[Type[BatchAdapterWeights]]:
@@ -164,40 +239,47 @@ class LoraWeights(AdapterWeights):
             lora_b_list = [None] * len(nlayers)
             layer_ids = nlayers
 
-        for i, layer_id in enumerate(layer_ids):
-            key = (layer_id, layer_type)
-            weight_name, layer = model.target_to_layer[key]
+        scale = get_scaling_factor(
+            config.lora_alpha,
+            config.r,
+            uses_rslora=config.use_rslora,
+        )
 
-            base_weight = layer.base_layer.linear.weight
-            base_device = base_weight.device
+        # all the layers of a shard live on the same device, so resolve it (and the dtype) once
+        target_to_layer = model.target_to_layer
+        dtype = model.dtype
+        base_device = None
+        if layer_ids:
+            _, first_layer = target_to_layer[(layer_ids[0], layer_type)]
+            base_device = first_layer.base_layer.linear.weight.device
 
+        for i, layer_id in enumerate(layer_ids):
+            weight_name, _ = target_to_layer[(layer_id, layer_type)]
             if weight_name not in module_map:
                 # There is no LoRA weight for this layer type in the adapter
                 return None
 
             lora_a, lora_a_name = module_map[weight_name]["lora_A"]
-            lora_a = load_module_weight(lora_a_name, lora_a, base_device, model.dtype)
+            lora_a = load_module_weight(lora_a_name, lora_a, base_device, dtype)
 
             lora_b, lora_b_name = module_map[weight_name]["lora_B"]
-            lora_b = load_module_weight(lora_b_name, lora_b, base_device, model.dtype)
-
-            scale = get_scaling_factor(
-                config.lora_alpha,
-                config.r,
-                uses_rslora=config.use_rslora,
-            )
+            lora_b = load_module_weight(lora_b_name, lora_b, base_device, dtype)
 
             unused_weight_names.discard(lora_a_name)
             unused_weight_names.discard(lora_b_name)
 
-            # Merge scaling factor into lora_b due to associativity of matrix multiplication:
-            # (A * B) * C = A * (B * C)
             lora_a_list[i] = lora_a.transpose(0, 1)
-            lora_b_list[i] = lora_b.transpose(0, 1) * scale
+            lora_b_list[i] = lora_b
 
         # pad lora ranks to be compatible with sgmv
         lora_a_list = [pad_rank(w, dim=1, world_size=model.world_size) for w in lora_a_list]
-        lora_b_list = [pad_rank(w, dim=0, world_size=model.world_size) for w in lora_b_list]
+        if lora_b_list:
+            # [num_layers, r, hidden_size]
+            lora_b = pad_rank(torch.stack(lora_b_list).transpose(1, 2), dim=1, world_size=model.world_size)
+
+            # Merge scaling factor into lora_b due to associativity of matrix multiplication:
+            # (A * B) * C = A * (B * C)
+            lora_b_list = list(lora_b.mul_(scale).unbind(0))
 
         if lora_a_list:
             # update rank if it was padded
@@ -210,6 +292,56 @@ class LoraWeights(AdapterWeights):
         )
 
 
+class FusedLoraWeights(LoraWeights):
+    """LoRA weights of several projections sharing the same input (e.g. q, k and v) packed into one adapter.
+
+    The A matrices are concatenated along the rank and the B matrices are laid out block diagonally, so a single
+    SGMV / BGMV call produces the concatenated outputs of all the projections.
+    """
+
+    @classmethod
+    def fuse(cls, weights: List[LoraWeights]) -> Optional["FusedLoraWeights"]:
+        first_weights = weights[0]
+        rank = first_weights.lora_a_r
+        if any(w.lora_a_r != rank or w.lora_b_r != first_weights.lora_b_r for w in weights):
+            return None
+
+        # column parallel layers shard A along the rank, which is all-gathered before multiplying by B
+        if first_weights.lora_b_r % rank != 0:
+            return None
+        world_size = first_weights.lora_b_r // rank
+
+        # pad the fused rank to a power of 2 so it stays compatible with the kernels
+        fused_rank = 1 << (len(weights) * rank - 1).bit_length()
+        if fused_rank > BGMV_MAX_RANK:
+            return None
+
+        # [num_layers, hidden_size, fused_rank]
+        lora_a = torch.cat(
+            [
+                w.weights_a.transpose(1, 2) if MIN_RANK_CUSTOM <= rank <= MAX_RANK_CUSTOM else w.weights_a
+                for w in weights
+            ],
+            dim=2,
+        )
+        lora_a = pad_to_min_rank(lora_a, dim=2, min_rank=fused_rank)
+
+        # [num_layers, world_size * fused_rank, sum(hidden_sizes)]
+        # rows follow the order of the gathered ranks, i.e. for every shard the rank slices of each projection
+        hidden_sizes = [w.weights_b.size(2) for w in weights]
+        lora_b = lora_a.new_zeros((lora_a.size(0), world_size * fused_rank, sum(hidden_sizes)))
+        col = 0
+        for i, w in enumerate(weights):
+            for shard in range(world_size):
+                row = shard * fused_rank + i * rank
+                lora_b[:, row : row + rank, col : col + hidden_sizes[i]] = w.weights_b[
+                    :, shard * rank : (shard + 1) * rank
+                ]
+            col += hidden_sizes[i]
+
+        return cls(list(lora_a.unbind(0)), list(lora_b.unbind(0)), first_weights.adapter_config)
+
+
 @dataclass
 class RankSegments:
     rank: int
@@ -229,16 +361,17 @@ class RankSegments:
 
 @dataclass
 class BatchLoraWeights(BatchAdapterWeights):
-    lora_a: Dict[int, torch.Tensor]
-    lora_b: Dict[int, torch.Tensor]
-    adapter_index_configs: Dict[int, LoraConfig]
+    adapter_weights: Dict[int, LoraWeights]
     rank_data: Dict[int, RankSegments]
     use_sgmv: bool
     layer_name: str
     prefill_head_indices: Optional[torch.Tensor]
 
+    # number of segments whose adapter has lora weights, which is the length of the segment wise pointer arrays
+    valid_segment_count: int
+
     def has_adapter(self, adapter_index: int) -> bool:
-        return adapter_index in self.adapter_index_configs
+        return adapter_index in self.adapter_weights
 
     def can_vectorize(self, pg: ProcessGroup) -> bool:
         return (
@@ -264,138 +397,198 @@ class BatchLoraWeights(BatchAdapterWeights):
         if not adapter_weights:
             return None
 
-        first_weights = list(adapter_weights.values())[0]
-        device = first_weights.weights_a.device
+        device = next(iter(adapter_weights.values())).device
         segment_indices = meta.segment_indices
 
-        lora_a = {idx: adapter_weights[idx].weights_a for idx in segment_indices if idx in adapter_weights}
-        lora_b = {idx: adapter_weights[idx].weights_b for idx in segment_indices if idx in adapter_weights}
-
-        segment_ranks = [adapter_weights[idx].lora_a_r for idx in segment_indices if idx in adapter_weights]
-        if not segment_ranks:
-            return None
-
-        max_rank = max(segment_ranks)
-        if prefill or max_rank > BGMV_MAX_RANK:
-            use_sgmv = True
-            lora_a_ptr = torch.tensor(
-                [
-                    (adapter_weights[idx].weights_a.data_ptr() if idx in adapter_weights else EMPTY_TENSOR.data_ptr())
-                    for idx in segment_indices
-                ],
-                dtype=torch.int64,
-                device=device,
-            )
-            lora_b_ptr = torch.tensor(
-                [
-                    (adapter_weights[idx].weights_b.data_ptr() if idx in adapter_weights else EMPTY_TENSOR.data_ptr())
-                    for idx in segment_indices
-                ],
-                dtype=torch.int64,
-                device=device,
-            )
-        else:
-            use_sgmv = False
-            lora_a_ptr = torch.tensor(
-                [
-                    (adapter_weights[idx].weights_a_t.data_ptr() if idx in adapter_weights else EMPTY_TENSOR.data_ptr())
-                    for idx in segment_indices
-                ],
-                dtype=torch.int64,
-                device=device,
-            )
-            lora_b_ptr = torch.tensor(
-                [
-                    (adapter_weights[idx].weights_b_t.data_ptr() if idx in adapter_weights else EMPTY_TENSOR.data_ptr())
-                    for idx in segment_indices
-                ],
-                dtype=torch.int64,
-                device=device,
+        if len(segment_indices) == 1 and prefill_head_indices is None:
+            # fast path for batches where every token uses the same adapter
+            return self._load_single_segment(adapter_weights, meta, layer_name, prefill)
+
+        # a single pass over the adapters collects their location within `adapter_weights`, their rank and their
+        # (lora_a, lora_b) pointers for both the SGMV and the BGMV orientation
+        adapter_locs = {}
+        adapter_ranks = np.empty(len(adapter_weights), dtype=np.int64)
+        ptr_table = np.empty((len(adapter_weights), 4), dtype=np.int64)
+        for loc, (idx, weights) in enumerate(adapter_weights.items()):
+            adapter_locs[idx] = loc
+            adapter_ranks[loc] = weights.lora_a_r
+            ptr_table[loc] = (
+                weights.weights_a_ptr,
+                weights.weights_b_ptr,
+                weights.weights_a_t_ptr,
+                weights.weights_b_t_ptr,
             )
 
-        adapter_index_configs = {
-            idx: adapter_weights[idx].adapter_config for idx in segment_indices if idx in adapter_weights
-        }
+        # location of the adapter of each segment, -1 if the adapter has no lora weights
+        segment_locs = np.fromiter(
+            (adapter_locs.get(idx, -1) for idx in segment_indices), dtype=np.int64, count=len(segment_indices)
+        )
 
-        rank_indices = defaultdict(list)
-        for segment_idx, adapter_idx in enumerate(segment_indices):
-            if adapter_idx not in adapter_weights:
-                continue
-            rank_indices[adapter_weights[adapter_idx].lora_a_r].append(segment_idx)
+        # only the valid segments are given pointers, position `i` of the pointer arrays is `valid_segments[i]`
+        valid_segments = np.flatnonzero(segment_locs >= 0)
+        if len(valid_segments) == 0:
+            return None
+        valid_locs = segment_locs[valid_segments]
+
+        valid_ranks = adapter_ranks[valid_locs]
+        max_rank = int(valid_ranks.max())
+        use_sgmv = prefill or max_rank > BGMV_MAX_RANK
+        ptr_table = ptr_table[:, :2] if use_sgmv else ptr_table[:, 2:]
+
+        # order the valid segments by rank (keeping their order within a rank), so the pointers and segments of
+        # each rank are a contiguous slice of the arrays moved to the device
+        rank_order = np.argsort(valid_ranks, kind="stable")
+        ranks, rank_counts = np.unique(valid_ranks, return_counts=True)
+        rank_offsets = np.concatenate(([0], np.cumsum(rank_counts)))
+        rank_segments = valid_segments[rank_order]
+
+        bgmv_tables = []
+        if not use_sgmv:
+            # for each rank, the sorted adapter indices of its segments and the location of their first segment
+            # within the rank's segments, used to map the adapter index of each token to its pointers
+            rank_segment_adapters = np.asarray(segment_indices, dtype=np.int64)[rank_segments]
+            for start, end in zip(rank_offsets[:-1], rank_offsets[1:]):
+                adapter_keys, adapter_locs = np.unique(rank_segment_adapters[start:end], return_index=True)
+                bgmv_tables.extend((adapter_keys, adapter_locs))
+
+        # move the pointers for both weights, the segments and the BGMV tables with a single transfer
+        staged = np.concatenate((ptr_table[valid_locs[rank_order]].T.ravel(), rank_segments, *bgmv_tables))
+        staged_d = _ptrs_to_device(staged, device, meta, layer_name)
+        lora_a_ptr, lora_b_ptr, rank_segments_d = staged_d[: 3 * len(rank_segments)].chunk(3)
+        if bgmv_tables:
+            bgmv_tables_d = staged_d[3 * len(rank_segments) :].split([len(t) for t in bgmv_tables])
+
+        segment_adapter_weights = {idx: adapter_weights[idx] for idx in segment_indices if idx in adapter_weights}
 
         if prefill_head_indices is not None:
-            j, prefill_head_segment_starts, prefill_head_segment_ends = 1, [0], [0]
-            for head_index in prefill_head_indices:
-                # j cannot go out of bounds as that would mean there are tokens without corresponding adapters
-                if head_index < meta.adapter_segments[j]:
-                    prefill_head_segment_ends[-1] += 1
-                else:
-                    prefill_head_segment_starts.append(prefill_head_segment_ends[-1])
-                    prefill_head_segment_ends.append(prefill_head_segment_ends[-1] + 1)
-                    j += 1
+            # the heads are sorted, so the head segment boundaries are the number of heads before each token segment
+            # boundary; unlike counting the heads per segment (bincount) this never synchronizes with the device
+            # every segment has at least one head, as otherwise there would be tokens without corresponding adapters
+            token_boundaries = meta.adapter_segments.to(prefill_head_indices.dtype)
+            segment_boundaries = torch.searchsorted(prefill_head_indices, token_boundaries)
+            segment_boundaries = segment_boundaries.to(meta.adapter_segments.dtype)
+        else:
+            segment_boundaries = meta.adapter_segments
 
         rank_data = {}
-        for rank, indices in rank_indices.items():
+        rank_bounds = zip(ranks.tolist(), rank_offsets[:-1].tolist(), rank_offsets[1:].tolist())
+        for i, (rank, start, end) in enumerate(rank_bounds):
             tmp_shrink = None
             tmp_expand = None
             segment_starts = None
             segment_ends = None
             batch_indices = None
 
+            rank_lora_a_ptr = lora_a_ptr[start:end]
+            rank_lora_b_ptr = lora_b_ptr[start:end]
+
             if use_sgmv:
-                lora_a_ptr_indices = lora_a_ptr[indices]
-                tmp_shrink, tmp_expand = get_tmp_tensors(lora_a_ptr_indices.size(0), rank, device)
-                segment_starts = meta.adapter_segments[indices]
-                segment_ends = meta.adapter_segments[[i + 1 for i in indices]]
-                if prefill_head_indices is not None:
-                    for i, segment_index in enumerate(indices):
-                        segment_starts[i] = prefill_head_segment_starts[segment_index]
-                        segment_ends[i] = prefill_head_segment_ends[segment_index]
+                tmp_shrink, tmp_expand = get_tmp_tensors(rank_lora_a_ptr.size(0), rank, device)
+                build_sgmv_segments = _get_meta_builder(_build_sgmv_segments)
+                segment_starts, segment_ends = build_sgmv_segments(segment_boundaries, rank_segments_d[start:end])
             else:
-                # `indices` indexes the `segment_indices` which contains segment wise adapter index
-                # `lora_a_ptr` contains segment wise pointers to lora weights
-                # lengths of `lora_a_ptr` and `segment_indices` must be same
-                # `indices` will be used to slice the `lora_a_ptr` tensor
-                # first, find the mapping between adapter index and its location in the `indices` array
-                idx_locs = {}
-                for loc, idx in enumerate(indices):
-                    # use the idx to find the adapter index
-                    if segment_indices[idx] not in idx_locs:
-                        # save the first location of encountering a particular adapter index
-                        idx_locs[segment_indices[idx]] = loc
-
-                # second, iterate over the adapter index for each token and find its location in the `indices` array
-                batch_indices = torch.tensor(
-                    [
-                        idx_locs[idx] if idx in adapter_weights and adapter_weights[idx].lora_a_r == rank else -1
-                        for idx in meta.adapter_indices.tolist()
-                    ],
-                    dtype=torch.int64,
-                    device=device,
+                # map the adapter index of each token to its location in the rank's segments on device,
+                # tokens whose adapter is not of this rank are given -1
+                adapter_keys_d, adapter_locs_d = bgmv_tables_d[2 * i], bgmv_tables_d[2 * i + 1]
+                build_bgmv_indices = _get_meta_builder(_build_bgmv_indices)
+                batch_indices = build_bgmv_indices(
+                    adapter_keys_d.to(meta.adapter_indices.dtype), adapter_locs_d, meta.adapter_indices
                 )
 
             rank_data[rank] = RankSegments(
                 rank=rank,
                 tmp_shrink=tmp_shrink,
                 tmp_expand=tmp_expand,
-                lora_a_ptr=lora_a_ptr[indices],
-                lora_b_ptr=lora_b_ptr[indices],
+                lora_a_ptr=rank_lora_a_ptr,
+                lora_b_ptr=rank_lora_b_ptr,
                 segment_starts=segment_starts,
                 segment_ends=segment_ends,
                 indices=batch_indices,
             )
 
         return BatchLoraWeights(
-            lora_a=lora_a,
-            lora_b=lora_b,
-            adapter_index_configs=adapter_index_configs,
+            adapter_weights=segment_adapter_weights,
             rank_data=rank_data,
             use_sgmv=use_sgmv,
             layer_name=layer_name,
             prefill_head_indices=prefill_head_indices,
+            valid_segment_count=len(valid_segments),
+        )
+
+    @classmethod
+    def _load_single_segment(
+        cls,
+        adapter_weights: Dict[int, LoraWeights],
+        meta: AdapterBatchMetadata,
+        layer_name: str,
+        prefill: bool,
+    ) -> Optional["BatchLoraWeights"]:
+        adapter_index = meta.segment_indices[0]
+        weights = adapter_weights.get(adapter_index)
+        if weights is None:
+            return None
+
+        rank = weights.lora_a_r
+        use_sgmv = prefill or rank > BGMV_MAX_RANK
+        lora_a_ptr, lora_b_ptr = weights.singleton_ptrs(use_sgmv)
+
+        tmp_shrink = None
+        tmp_expand = None
+        segment_starts = None
+        segment_ends = None
+        batch_indices = None
+        if use_sgmv:
+            tmp_shrink, tmp_expand = get_tmp_tensors(1, rank, weights.device)
+            segment_starts = meta.adapter_segments[:1]
+            segment_ends = meta.adapter_segments[1:]
+        else:
+            batch_indices = torch.zeros_like(meta.adapter_indices)
+
+        return BatchLoraWeights(
+            adapter_weights={adapter_index: weights},
+            rank_data={
+                rank: RankSegments(
+                    rank=rank,
+                    tmp_shrink=tmp_shrink,
+                    tmp_expand=tmp_expand,
+                    lora_a_ptr=lora_a_ptr,
+                    lora_b_ptr=lora_b_ptr,
+                    segment_starts=segment_starts,
+                    segment_ends=segment_ends,
+                    indices=batch_indices,
+                )
+            },
+            use_sgmv=use_sgmv,
+            layer_name=layer_name,
+            prefill_head_indices=None,
+            valid_segment_count=1,
         )
 
 
+def _build_sgmv_segments(segment_boundaries: torch.Tensor, indices: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Returns the start and end of the segments at `indices` given the boundaries of all the segments."""
+    return segment_boundaries[indices], segment_boundaries[indices + 1]
+
+
+def _build_bgmv_indices(
+    adapter_keys: torch.Tensor, adapter_locs: torch.Tensor, adapter_indices: torch.Tensor
+) -> torch.Tensor:
+    """Maps the adapter index of each token to the location of its pointers, or -1 if the adapter is not in
+    the sorted `adapter_keys`."""
+    key_pos = torch.searchsorted(adapter_keys, adapter_indices).clamp(max=adapter_keys.size(0) - 1)
+    return torch.where(adapter_keys[key_pos] == adapter_indices, adapter_locs[key_pos], -1)
+
+
+@lru_cache(maxsize=None)
+def _compile_meta_builder(fn: Callable) -> Callable:
+    # shapes change with the batch composition, so compile dynamically rather than once per shape
+    return torch.compile(fn, dynamic=True, fullgraph=True)
+
+
+def _get_meta_builder(fn: Callable) -> Callable:
+    return _compile_meta_builder(fn) if LORAX_COMPILE_LORA_META else fn
+
+
 def get_scaling_factor(
     lora_alpha: int,
     r: int,
@@ -407,6 +600,108 @@ def get_scaling_factor(
     return lora_alpha / r
 
 
+class PtrStagingRing:
+    """Ring of preallocated pinned host and device buffers used to move pointer arrays to the device.
+
+    Each forward step bump allocates from the next slot of the ring, so the buffers handed out for a step remain
+    valid while the following `size - 1` steps are prepared. A new step starts when the adapter metadata changes or
+    when a layer is prepared again for the same metadata (decode steps reuse the metadata of the batch). Device
+    buffers are only overwritten by copies issued on the stream after the kernels reading them, and host buffers are
+    only overwritten once the copies reading them have completed.
+    """
+
+    def __init__(self, device: torch.device, size: int = PTR_STAGING_RING_SIZE, capacity: int = PTR_STAGING_CAPACITY):
+        self.device = device
+        self.capacity = capacity
+        self.host_buffers = [torch.empty(capacity, dtype=torch.int64, pin_memory=True) for _ in range(size)]
+        self.device_buffers = [torch.empty(capacity, dtype=torch.int64, device=device) for _ in range(size)]
+        self.events: List[Optional[torch.cuda.Event]] = [None] * size
+        self.slot = 0
+        self.offset = 0
+        self.meta_ref = None
+        self.layer_names: Set[str] = set()
+
+    def to_device(self, ptrs: np.ndarray, meta: AdapterBatchMetadata, layer_name: str) -> Optional[torch.Tensor]:
+        if self.meta_ref is None or self.meta_ref() is not meta or layer_name in self.layer_names:
+            self._next_slot(meta)
+        self.layer_names.add(layer_name)
+
+        start, end = self.offset, self.offset + len(ptrs)
+        if end > self.capacity:
+            return None
+        self.offset = end
+
+        host_buf = self.host_buffers[self.slot][start:end]
+        host_buf.numpy()[:] = ptrs
+        device_buf = self.device_buffers[self.slot][start:end]
+        device_buf.copy_(host_buf, non_blocking=True)
+        return device_buf
+
+    def _next_slot(self, meta: AdapterBatchMetadata):
+        if self.meta_ref is not None:
+            # everything reading from the current slot has been enqueued by the time the next batch is prepared
+            event = torch.cuda.Event()
+            event.record(torch.cuda.current_stream(self.device))
+            self.events[self.slot] = event
+
+        self.slot = (self.slot + 1) % len(self.host_buffers)
+        if self.events[self.slot] is not None:
+            self.events[self.slot].synchronize()
+            self.events[self.slot] = None
+
+        self.offset = 0
+        self.meta_ref = weakref.ref(meta)
+        self.layer_names.clear()
+
+
+@lru_cache(maxsize=None)
+def get_ptr_staging_ring(device: torch.device) -> PtrStagingRing:
+    return PtrStagingRing(device)
+
+
+def _ptrs_to_device(
+    ptrs: np.ndarray, device: torch.device, meta: AdapterBatchMetadata, layer_name: str
+) -> torch.Tensor:
+    """Copies an int64 array of pointers (and indices) to the device with a single (async) host to device transfer."""
+    if device.type == "cuda":
+        ptr_tensor = get_ptr_staging_ring(device).to_device(ptrs, meta, layer_name)
+        if ptr_tensor is not None:
+            return ptr_tensor
+
+    # batch is too large for the preallocated buffers
+    buf = torch.from_numpy(ptrs)
+    if device.type == "cuda":
+        buf = buf.pin_memory()
+    return buf.to(device, non_blocking=True)
+
+
+def _alloc_packed(tensors: List[torch.Tensor]) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+    """Copies the tensors into contiguous views of one byte buffer, each starting at an aligned offset.
+
+    The tensors may have different dtypes, each view keeps the dtype of the tensor it was copied from.
+    """
+    offsets = []
+    total = 0
+    for t in tensors:
+        offsets.append(total)
+        total += -(-t.numel() * t.element_size() // WEIGHTS_ALIGNMENT) * WEIGHTS_ALIGNMENT
+
+    buffer = torch.empty(total, dtype=torch.uint8, device=tensors[0].device)
+    views = []
+    for t, offset in zip(tensors, offsets):
+        view = buffer[offset : offset + t.numel() * t.element_size()].view(t.dtype).view(t.shape)
+        view.copy_(t)
+        views.append(view)
+    return buffer, views
+
+
+def _quantize_int8(t: torch.Tensor, dim: int = -1) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric int8 quantization along `dim`, returns the quantized tensor and its scales (with `dim` of size 1)."""
+    scale = t.abs().amax(dim=dim, keepdim=True).float().clamp_(min=1e-8) / 127.0
+    q = (t.float() / scale).round_().clamp_(-127, 127).to(torch.int8)
+    return q, scale.to(t.dtype)
+
+
 def _convert_lora(v: AdapterWeights) -> AdapterWeights:
     if hasattr(v, "lora_weights"):
         return v.lora_weights
@@ -4,12 +4,14 @@ from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple, Type
 import torch
 
 from lorax_server.adapters.config import AdapterConfig, ModuleMap
-from lorax_server.adapters.lora import BatchLoraWeights, LoraConfig, LoraWeights
+from lorax_server.adapters.lora import BatchLoraWeights, LoraConfig, LoraWeights, is_lora_weight
 from lorax_server.adapters.medusa import BatchMedusaWeights, MedusaConfig, MedusaWeights
 from lorax_server.adapters.weights import AdapterWeights, BatchAdapterWeights
+from lorax_server.utils.punica import LORA_RESIDENT_SIZE_FACTOR
 
 if TYPE_CHECKING:
     from lorax_server.models.model import Model
+    from lorax_server.utils.sources.source import BaseModelSource
 
 EMPTY_TENSOR = torch.tensor([])
 
@@ -53,6 +55,11 @@ class MedusaLoraConfig(AdapterConfig):
             medusa_weights,
         )
 
+    def get_resident_bytes(self, source: "BaseModelSource") -> int:
+        # only the LoRA weights are kept in more than one layout, the medusa heads are loaded as they are
+        lora_bytes = source.get_weight_bytes(is_lora_weight)
+        return source.get_weight_bytes() + int(lora_bytes * (LORA_RESIDENT_SIZE_FACTOR - 1))
+
     @classmethod
     def load(cls, adapter_id: str, config: dict, api_token: str) -> "MedusaLoraConfig":
         lora_config = LoraConfig.load(adapter_id, api_token)
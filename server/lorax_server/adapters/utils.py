@@ -22,9 +22,9 @@ def download_adapter_weights(
 
     # fail fast if ID is not an adapter (i.e. it is a full model)
     source = get_model_source(adapter_source, adapter_id, extension=".safetensors", api_token=api_token)
-    source.load_config()
+    adapter_config = source.load_config()
 
     download_weights(adapter_id, source=adapter_source, api_token=api_token)
 
     # Calculate size of adapter to be loaded
-    return source.get_weight_bytes()
+    return adapter_config.get_resident_bytes(source)
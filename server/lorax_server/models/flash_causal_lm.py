@@ -1174,6 +1174,7 @@ class FlashCausalLM(Model):
             trust_remote_code=trust_remote_code,
             processor=processor,
             supports_chunking=supports_chunking,
+            compile=compile,
         )
 
         if sliding_window is not None:
@@ -1181,8 +1182,6 @@ class FlashCausalLM(Model):
             SLIDING_WINDOW = sliding_window
             SLIDING_WINDOW_BLOCKS = math.ceil(sliding_window / BLOCK_SIZE)
 
-        self.compile = compile
-
         self.model_graph_wrapper: GraphCache = None
         self.kv_cache = []
 
@@ -7,7 +7,7 @@ import torch
 from loguru import logger
 from transformers import PreTrainedTokenizerBase
 
-from lorax_server.adapters.lora import LoraWeights
+from lorax_server.adapters.lora import FusedLoraWeights, LoraWeights
 from lorax_server.adapters.medusa_lora import MedusaLoraWeights
 from lorax_server.adapters.utils import download_adapter_weights
 from lorax_server.adapters.weights import LayerAdapterWeights
@@ -18,7 +18,13 @@ from lorax_server.utils.adapter import (
     BASE_MODEL_ADAPTER_ID,
     load_and_merge_adapters,
 )
-from lorax_server.utils.punica import LORAX_PUNICA_TRITON_DISABLED, pad_to_min_rank, use_cutlass_shrink
+from lorax_server.utils.lora import K_PROJ, Q_PROJ, QKV_PROJ_FUSED, V_PROJ
+from lorax_server.utils.punica import (
+    LORAX_FUSE_QKV_LORA,
+    LORAX_PUNICA_TRITON_DISABLED,
+    pad_to_min_rank,
+    use_cutlass_shrink,
+)
 from lorax_server.utils.sources import HUB
 from lorax_server.utils.state import (
     BLOCK_SIZE,
@@ -52,6 +58,7 @@ class Model(ABC):
         trust_remote_code: bool = False,
         processor=None,
         supports_chunking: bool = False,
+        compile: bool = False,
     ):
         self.model_id = model_id
         self.model = model.eval()
@@ -71,6 +78,7 @@ class Model(ABC):
         self.rank = rank
         self.world_size = world_size
         self.sliding_window = sliding_window
+        self.compile = compile
 
         # This may be set to False in the subclass constructor
         self.dynamic_adapter_loading_enabled = dynamic_adapter_loading_enabled
@@ -246,7 +254,8 @@ class Model(ABC):
     @property
     def traced_adapter_layers(self) -> List[str]:
         if self.layer_to_adapter_weights:
-            return list(self.layer_to_adapter_weights.keys())
+            # packed q, k, v adapters have no graph buffers, batches using them always run eagerly
+            return [layer_name for layer_name in self.layer_to_adapter_weights.keys() if layer_name != QKV_PROJ_FUSED]
         return self.default_traced_adapter_layers
 
     @property
@@ -394,6 +403,9 @@ class Model(ABC):
             layer_weights = self.layer_to_adapter_weights[layer_name]
             layer_weights.add_adapter(adapter_index, adapter_weights)
 
+        if LORAX_FUSE_QKV_LORA:
+            self.fuse_qkv_adapter_weights(adapter_index)
+
         if len(unused_weight_names) > 0:
             logger.warning(f"{','.join(adapter_parameters.adapter_ids)} unused adapter weights: {unused_weight_names}")
 
@@ -402,6 +414,56 @@ class Model(ABC):
 
         self.loaded_adapters.add(adapter_index)
 
+    def can_fuse_qkv(self) -> bool:
+        """Returns True if the q, k and v projections of every layer are applied by one module that handles the
+        packed LoRA, i.e. a multi adapter linear over exactly the q, k and v layers."""
+        qkv_layers = [Q_PROJ, K_PROJ, V_PROJ]
+        layer_ids = [layer_id for layer_id, layer_type in self.target_to_layer if layer_type == Q_PROJ]
+        if not layer_ids:
+            return False
+
+        for layer_id in layer_ids:
+            targets = [self.target_to_layer.get((layer_id, layer_name)) for layer_name in qkv_layers]
+            if any(target is None for target in targets):
+                return False
+
+            module = targets[0][1]
+            if any(target[1] is not module for target in targets):
+                # e.g. cross attention, where q, k and v are separate linears with different inputs
+                return False
+            if getattr(module, "layer_names", None) != qkv_layers:
+                return False
+
+        return True
+
+    def fuse_qkv_adapter_weights(self, adapter_index: int):
+        """Packs the q, k and v LoRA weights of the adapter into a single LoRA, so they can be applied in one pass."""
+        qkv_layers = [Q_PROJ, K_PROJ, V_PROJ]
+        if not all(layer_name in self.layer_to_adapter_weights for layer_name in qkv_layers):
+            return
+
+        if self.compile:
+            # CUDA graphs can't replay batches with packed adapters, falling back to eager decode for every
+            # batch using them costs more than the saved kernel launches
+            return
+
+        if not self.can_fuse_qkv():
+            return
+
+        qkv_weights = [
+            self.layer_to_adapter_weights[layer_name].adapter_weights.get(adapter_index) for layer_name in qkv_layers
+        ]
+        if not all(type(weights) is LoraWeights for weights in qkv_weights):
+            return
+
+        fused_weights = FusedLoraWeights.fuse(qkv_weights)
+        if fused_weights is None:
+            return
+
+        self.layer_to_adapter_weights[QKV_PROJ_FUSED].add_adapter(adapter_index, fused_weights)
+        for layer_name in qkv_layers:
+            self.layer_to_adapter_weights[layer_name].remove_adapter(adapter_index)
+
     def shard_lora_weights(
         self,
         weights_a: List[torch.Tensor],
@@ -442,7 +504,7 @@ class Model(ABC):
                 "to use the dynamic adapter loading feature."
             )
 
-        for layer_name in self.adapter_layers:
+        for layer_name in [*self.adapter_layers, QKV_PROJ_FUSED]:
             if layer_name in self.layer_to_adapter_weights:
                 self.layer_to_adapter_weights[layer_name].remove_adapter(adapter_index)
 
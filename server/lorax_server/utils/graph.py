@@ -18,6 +18,7 @@ from lorax_server.adapters.lora import BatchLoraWeights, RankSegments
 from lorax_server.adapters.types import LORA
 from lorax_server.models.metadata_kernels import block_tables_to_ragged
 from lorax_server.utils.attention.common import Seqlen
+from lorax_server.utils.lora import QKV_PROJ_FUSED
 from lorax_server.utils.punica import BGMV_MAX_RANK, PunicaWrapper
 from lorax_server.utils.state import BLOCK_SIZE, FLASH_INFER, get_speculative_tokens
 
@@ -118,9 +119,7 @@ def get_max_graph_state(
     adapter_weight_data = {}
     for layer_name in adapter_layers:
         adapter_weight_data[layer_name] = BatchLoraWeights(
-            lora_a={},
-            lora_b={},
-            adapter_index_configs={},
+            adapter_weights={},
             rank_data={
                 MAX_RANK: RankSegments(
                     rank=MAX_RANK,
@@ -136,6 +135,7 @@ def get_max_graph_state(
             use_sgmv=False,  # bgmv during decode
             layer_name=layer_name,
             prefill_head_indices=None,
+            valid_segment_count=MAX_BATCH_SIZE,
         )
 
     return GraphState(
@@ -223,9 +223,7 @@ class GraphWrapper:
 
             adapter_weight_data[layer_name] = {
                 LORA: BatchLoraWeights(
-                    lora_a={},
-                    lora_b={},
-                    adapter_index_configs={},
+                    adapter_weights={},
                     rank_data=(
                         {
                             max_rank: RankSegments(
@@ -245,6 +243,7 @@ class GraphWrapper:
                     use_sgmv=False,  # bgmv during decode
                     layer_name=layer_name,
                     prefill_head_indices=None,
+                    valid_segment_count=segment_size if max_rank > 0 else 0,
                 )
             }
 
@@ -488,6 +487,7 @@ class GraphCache:
         max_s = batch.max_current_length
 
         # TODO(travis): allow using CUDA graphs with multi-rank batches
+        # packed q, k, v adapters have no graph buffers (and are not fused when graphs are enabled)
         return (
             torch.cuda.is_available()
             and batch_size <= MAX_BATCH_SIZE
@@ -495,6 +495,7 @@ class GraphCache:
             and max_rank <= MAX_RANK
             and nranks <= 1
             and max_rank in _allowed_ranks
+            and QKV_PROJ_FUSED not in adapter_data.layer_names()
         )
 
     def get_estimated_cache_memory(self) -> int:
@@ -11,7 +11,7 @@ from torch.nn import functional as F
 from lorax_server.adapters.types import LORA, MEDUSA
 from lorax_server.layers.linear import FastLinear, get_linear  # noqa: F401
 from lorax_server.layers.tensor_parallel import SuperLayer, TensorParallelColumnLinear, TensorParallelHead  # noqa: F401
-from lorax_server.utils.lora import LM_HEAD
+from lorax_server.utils.lora import K_PROJ, LM_HEAD, Q_PROJ, QKV_PROJ_FUSED, V_PROJ
 from lorax_server.utils.punica import (
     add_lora_a_bgmv,
     add_lora_b_bgmv,
@@ -198,8 +198,9 @@ class LoraLinear(nn.Module):
         adapter_index: int,
         adapter_mask: torch.Tensor,
     ) -> torch.Tensor:
-        lora_a = data.lora_a[adapter_index][self.layer_id, :, :]
-        lora_b = data.lora_b[adapter_index][self.layer_id, :, :]
+        weights = data.adapter_weights[adapter_index]
+        lora_a = weights.weights_a[self.layer_id, :, :]
+        lora_b = weights.weights_b[self.layer_id, :, :]
 
         lora_a = orient_for_rank(lora_a, lora_b.size(0))
 
@@ -237,6 +238,11 @@ class TensorParallelMultiAdapterLinear(LoraLinear):
             input = input.reshape(-1, input.shape[-1])
             result = result.reshape(-1, result.shape[-1])
 
+        if self.layer_names == [Q_PROJ, K_PROJ, V_PROJ] and QKV_PROJ_FUSED in adapter_data.data:
+            # adapters with packed q, k and v weights cover the whole output in a single pass,
+            # any remaining adapters are applied per layer below
+            result = self.forward_layer_type(result, input, adapter_data, QKV_PROJ_FUSED, 0, result.shape[1])
+
         offset = 0
         for i, layer_name in enumerate(self.layer_names):
             start_idx = offset // self.process_group.size()
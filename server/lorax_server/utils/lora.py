@@ -4,6 +4,9 @@ K_PROJ = "k_proj"
 V_PROJ = "v_proj"
 O_PROJ = "o_proj"
 
+# Q_PROJ, K_PROJ and V_PROJ adapters packed into a single LoRA
+QKV_PROJ_FUSED = "qkv_proj_fused"
+
 GATE_PROJ = "gate_proj"
 UP_PROJ = "up_proj"
 DOWN_PROJ = "down_proj"
@@ -31,6 +31,31 @@ LORAX_PUNICA_TRITON_DISABLED = bool(int(os.environ.get("LORAX_PUNICA_TRITON_DISA
 if LORAX_PUNICA_TRITON_DISABLED:
     logger.info("LORAX_PUNICA_TRITON_DISABLED is set, disabling Punica Trion kernels.")
 
+# Packing the q, k and v adapters into one LoRA is only supported by the SGMV / BGMV kernels
+LORAX_FUSE_QKV_LORA = bool(int(os.environ.get("LORAX_FUSE_QKV_LORA", "0")))
+if LORAX_FUSE_QKV_LORA and not LORAX_PUNICA_TRITON_DISABLED:
+    logger.warning("LORAX_FUSE_QKV_LORA requires LORAX_PUNICA_TRITON_DISABLED, disabling q, k, v LoRA fusion.")
+    LORAX_FUSE_QKV_LORA = False
+
+# torch.compile the tensor ops building the SGMV / BGMV segment metadata of each batch
+LORAX_COMPILE_LORA_META = bool(int(os.environ.get("LORAX_COMPILE_LORA_META", "0")))
+
+# Keep an int8 copy (with per row scales) of the LoRA weights for bandwidth bound decode kernels
+LORAX_LORA_INT8_CACHE = bool(int(os.environ.get("LORAX_LORA_INT8_CACHE", "0")))
+
+# Device memory used by loaded LoRA weights relative to their size on disk: both the SGMV and the BGMV orientation are
+# kept, plus an int8 copy of the BGMV orientation when enabled. The int8 copy also stores one scale per rank and layer,
+# which adds at most 2 / hidden_size on top and is not counted.
+LORA_RESIDENT_SIZE_FACTOR = 2.0 + (0.5 if LORAX_LORA_INT8_CACHE else 0.0)
+
+# Upper bound of the memory used by a packed q, k, v LoRA relative to the unfused weights, as accounted for above: the
+# fused rank is 3 * r padded to a power of 2 (less than 2 * 3 * r) and B is laid out block diagonally, so each of the
+# A and B matrices of the packed LoRA is less than 6x the size of the unfused ones
+FUSED_QKV_SIZE_FACTOR = 6.0
+if LORAX_FUSE_QKV_LORA:
+    # the unfused weights are still resident while the packed LoRA is built
+    LORA_RESIDENT_SIZE_FACTOR *= 1 + FUSED_QKV_SIZE_FACTOR
+
 
 MIN_SGMV_RANK = 8
 MIN_RANK_CUSTOM = 16
@@ -2,7 +2,7 @@ import json
 import os
 from abc import abstractmethod
 from pathlib import Path
-from typing import TYPE_CHECKING, List, Optional
+from typing import TYPE_CHECKING, Callable, List, Optional
 
 if TYPE_CHECKING:
     from lorax_server.adapters.config import AdapterConfig
@@ -72,7 +72,8 @@ class BaseModelSource:
     def download_file(self, filename: str, ignore_errors: bool = False) -> Optional[Path]:
         pass
 
-    def get_weight_bytes(self) -> int:
+    def get_weight_bytes(self, tensor_filter: Optional[Callable[[str], bool]] = None) -> int:
+        """Returns the size of the weights, only counting the tensors whose name passes `tensor_filter` if given."""
         total_size = 0
         for path in self.weight_files():
             fname = str(path)
@@ -95,6 +96,14 @@ class BaseModelSource:
 
                 hdrbuf = f.read(headerlen)
                 header = json.loads(hdrbuf)
+                if tensor_filter is not None:
+                    total_size += sum(
+                        v["data_offsets"][1] - v["data_offsets"][0]
+                        for k, v in header.items()
+                        if isinstance(v, dict) and "data_offsets" in v and tensor_filter(k)
+                    )
+                    continue
+
                 metadata = header.get("__metadata__", {})
                 total_size_bytes = metadata.get("total_size")
                 if total_size_bytes is None:
@@ -1,8 +1,15 @@
+from collections import defaultdict
+
 import pytest
 import torch
+from peft import LoraConfig
 from transformers import AutoTokenizer
 
+from lorax_server.adapters.lora import FusedLoraWeights, LoraWeights
+from lorax_server.adapters.weights import LayerAdapterWeights
 from lorax_server.models.model import Model
+from lorax_server.utils.layers import TensorParallelMultiAdapterLinear
+from lorax_server.utils.lora import K_PROJ, Q_PROJ, QKV_PROJ_FUSED, V_PROJ
 
 
 def get_test_model():
@@ -68,3 +75,67 @@ def test_decode_streaming_chinese_utf8():
         decoded_text += text
 
     assert decoded_text == truth
+
+
+def get_qkv_test_model(cross_attn_layers, compile=False):
+    class TestModel(Model):
+        def batch_type(self):
+            raise NotImplementedError
+
+        def generate_token(self, batch):
+            raise NotImplementedError
+
+    # skip loading a tokenizer, fusing only needs the adapter targets and weights
+    model = TestModel.__new__(TestModel)
+    model.compile = compile
+    model.layer_to_adapter_weights = defaultdict(LayerAdapterWeights)
+    model.target_to_layer = {}
+    for layer_id in range(2):
+        if layer_id in cross_attn_layers:
+            for layer_type in [Q_PROJ, K_PROJ, V_PROJ]:
+                linear = TensorParallelMultiAdapterLinear(torch.nn.Identity(), layer_id, [layer_type], None, None)
+                model.target_to_layer[(layer_id, layer_type)] = (f"{layer_id}.cross_attn.{layer_type}", linear)
+        else:
+            qkv = TensorParallelMultiAdapterLinear(torch.nn.Identity(), layer_id, [Q_PROJ, K_PROJ, V_PROJ], None, None)
+            for layer_type in [Q_PROJ, K_PROJ, V_PROJ]:
+                model.target_to_layer[(layer_id, layer_type)] = (f"{layer_id}.self_attn.{layer_type}", qkv)
+    return model
+
+
+@pytest.mark.parametrize(
+    "cross_attn_layers,compile,fused",
+    [
+        ([], False, True),
+        # packed adapters can't be replayed by CUDA graphs
+        ([], True, False),
+        ([1], False, False),
+        ([0, 1], False, False),
+    ],
+)
+def test_fuse_qkv_adapter_weights(cross_attn_layers, compile, fused):
+    model = get_qkv_test_model(cross_attn_layers, compile)
+    assert model.can_fuse_qkv() == (not cross_attn_layers)
+
+    h = 64
+    lora_rank = 8
+    adapter_index = 1
+    for layer_type in [Q_PROJ, K_PROJ, V_PROJ]:
+        weights = LoraWeights(
+            weights_a=[torch.randn((h, lora_rank), dtype=torch.float16) for _ in range(2)],
+            weights_b=[torch.randn((lora_rank, h), dtype=torch.float16) for _ in range(2)],
+            adapter_config=LoraConfig(r=lora_rank),
+        )
+        model.layer_to_adapter_weights[layer_type].add_adapter(adapter_index, weights)
+
+    model.fuse_qkv_adapter_weights(adapter_index)
+
+    for layer_type in [Q_PROJ, K_PROJ, V_PROJ]:
+        assert (adapter_index in model.layer_to_adapter_weights[layer_type].adapter_weights) != fused
+
+    if fused:
+        fused_weights = model.layer_to_adapter_weights[QKV_PROJ_FUSED].adapter_weights[adapter_index]
+        assert isinstance(fused_weights, FusedLoraWeights)
+        # packed adapters are applied eagerly and must not be traced
+        assert QKV_PROJ_FUSED not in model.traced_adapter_layers
+    else:
+        assert QKV_PROJ_FUSED not in model.layer_to_adapter_weights
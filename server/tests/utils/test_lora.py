@@ -1,15 +1,27 @@
 from typing import Dict, List, Optional, Tuple, Type
 from unittest import mock
 
+import numpy as np
 import pytest
 import torch
 from peft import LoraConfig
+from safetensors.torch import save_file
 
-from lorax_server.adapters.lora import LoraWeights
+from lorax_server.adapters.lora import FusedLoraWeights, LoraWeights, PtrStagingRing, _ptrs_to_device
+from lorax_server.adapters.lora import LoraConfig as LoraAdapterConfig
+from lorax_server.adapters.medusa import MedusaConfig
+from lorax_server.adapters.medusa_lora import MedusaLoraConfig
 from lorax_server.adapters.types import LORA
 from lorax_server.adapters.weights import AdapterBatchMetadata, AdapterWeights, BatchAdapterWeights, LayerAdapterWeights
-from lorax_server.utils.lora import LM_HEAD
-from lorax_server.utils.punica import MIN_RANK_CUSTOM
+from lorax_server.utils.layers import TensorParallelMultiAdapterLinear
+from lorax_server.utils.lora import K_PROJ, LM_HEAD, Q_PROJ, QKV_PROJ_FUSED, V_PROJ
+from lorax_server.utils.punica import (
+    FUSED_QKV_SIZE_FACTOR,
+    LORA_RESIDENT_SIZE_FACTOR,
+    MIN_RANK_CUSTOM,
+    orient_for_rank,
+)
+from lorax_server.utils.sources.source import BaseModelSource
 
 
 class FakeAdapterWeights(AdapterWeights):
@@ -83,15 +95,17 @@ def test_batched_lora_weights(lora_ranks: List[int]):
     with mock.patch("lorax_server.adapters.lora.get_tmp_tensors", return_value=(torch.empty(0), torch.empty(0))):
         data = batched_weights.get_data(meta, LM_HEAD, prefill=True, prefill_head_indices=None).get(LORA)
 
-    assert len(data.lora_a) == 2
-    assert data.lora_a.keys() == meta.adapter_set
-    assert data.lora_a[0].shape == ((1, h, lora_ranks[0]) if lora_ranks[0] < MIN_RANK_CUSTOM else (1, lora_ranks[0], h))
-    assert data.lora_a[1].shape == ((1, h, lora_ranks[1]) if lora_ranks[1] < MIN_RANK_CUSTOM else (1, lora_ranks[1], h))
+    assert len(data.adapter_weights) == 2
+    assert data.adapter_weights.keys() == meta.adapter_set
+    assert data.adapter_weights[0].weights_a.shape == (
+        (1, h, lora_ranks[0]) if lora_ranks[0] < MIN_RANK_CUSTOM else (1, lora_ranks[0], h)
+    )
+    assert data.adapter_weights[1].weights_a.shape == (
+        (1, h, lora_ranks[1]) if lora_ranks[1] < MIN_RANK_CUSTOM else (1, lora_ranks[1], h)
+    )
 
-    assert len(data.lora_b) == 2
-    assert data.lora_b.keys() == meta.adapter_set
-    assert data.lora_b[0].shape == (1, lora_ranks[0], h)
-    assert data.lora_b[1].shape == (1, lora_ranks[1], h)
+    assert data.adapter_weights[0].weights_b.shape == (1, lora_ranks[0], h)
+    assert data.adapter_weights[1].weights_b.shape == (1, lora_ranks[1], h)
 
     assert len(data.rank_data) == 2
     assert data.rank_data.keys() == set(lora_ranks)
@@ -104,6 +118,13 @@ def test_batched_lora_weights(lora_ranks: List[int]):
         assert rd.segment_starts.shape == (2,)
         assert rd.segment_ends.shape == (2,)
 
+        weights = batched_weights.adapter_weights[lora_ranks.index(lora_rank)]
+        assert rd.lora_a_ptr.tolist() == [weights.weights_a_ptr] * 2
+        assert rd.lora_b_ptr.tolist() == [weights.weights_b_ptr] * 2
+
+    # the pointers of each rank are slices of the same staged buffer rather than gathered copies
+    storages = {rd.lora_a_ptr.untyped_storage().data_ptr() for rd in data.rank_data.values()}
+    assert len(storages) == 1
 
 
 @pytest.mark.parametrize(
@@ -126,6 +147,14 @@ def test_batched_lora_weights(lora_ranks: List[int]):
                 16: (1, [-1, -1, -1, -1, -1, -1, -1, -1, 0, 0]),
             }
         ),
+        (
+            [8, 16, 8],
+            [2, 2, 0, 0, 1, 1],
+            {
+                8: (2, [0, 0, 1, 1, -1, -1]),
+                16: (1, [-1, -1, -1, -1, 0, 0]),
+            }
+        ),
     ],
 )
 def test_batched_lora_weights_decode(
@@ -205,3 +234,453 @@ def test_batched_lora_weights_no_segments():
         data = batched_weights.get_data(meta, LM_HEAD, prefill=True, prefill_head_indices=None).get(LORA)
 
     print(data)
+
+
+@pytest.mark.parametrize("prefill", [True, False])
+def test_batched_lora_weights_missing_segments(prefill: bool):
+    batched_weights = LayerAdapterWeights()
+    batched_weights.add_adapter(0, FakeAdapterWeights())
+
+    h = 1024
+    lora_rank = 16
+    weights = LoraWeights(
+        weights_a=[torch.randn((h, lora_rank), dtype=torch.float16)],
+        weights_b=[torch.randn((lora_rank, h), dtype=torch.float16)],
+        adapter_config=LoraConfig(r=lora_rank),
+    )
+    batched_weights.add_adapter(1, weights)
+
+    meta = AdapterBatchMetadata(
+        adapter_indices=torch.tensor([1, 1, 0, 0, 0, 1], dtype=torch.int64),
+        adapter_list=[1, 1, 0, 0, 0, 1],
+        adapter_set={0, 1},
+        adapter_segments=torch.tensor([0, 2, 5, 6], dtype=torch.int64),
+        segment_indices=[1, 0, 1],
+    )
+
+    with mock.patch("lorax_server.adapters.lora.get_tmp_tensors", return_value=(torch.empty(0), torch.empty(0))):
+        data = batched_weights.get_data(meta, LM_HEAD, prefill=prefill, prefill_head_indices=None).get(LORA)
+
+    # only the segments with lora weights are given pointers
+    assert data.valid_segment_count == 2
+    rd = data.rank_data[lora_rank]
+    if prefill:
+        assert rd.lora_a_ptr.tolist() == [weights.weights_a_ptr] * 2
+        assert rd.lora_b_ptr.tolist() == [weights.weights_b_ptr] * 2
+        assert rd.segment_starts.tolist() == [0, 5]
+        assert rd.segment_ends.tolist() == [2, 6]
+    else:
+        assert rd.lora_a_ptr.tolist() == [weights.weights_a_t_ptr] * 2
+        assert rd.lora_b_ptr.tolist() == [weights.weights_b_t_ptr] * 2
+        assert rd.indices.tolist() == [0, 0, -1, -1, -1, 0]
+
+
+@pytest.mark.parametrize("prefill", [True, False])
+def test_batched_lora_weights_single_segment(prefill: bool):
+    batched_weights = LayerAdapterWeights()
+
+    h = 1024
+    lora_rank = 8
+    weights = LoraWeights(
+        weights_a=[torch.randn((h, lora_rank), dtype=torch.float16)],
+        weights_b=[torch.randn((lora_rank, h), dtype=torch.float16)],
+        adapter_config=LoraConfig(r=lora_rank),
+    )
+    batched_weights.add_adapter(1, weights)
+
+    meta = AdapterBatchMetadata(
+        adapter_indices=torch.tensor([1, 1, 1, 1], dtype=torch.int64),
+        adapter_list=[1, 1, 1, 1],
+        adapter_set={1},
+        adapter_segments=torch.tensor([0, 4], dtype=torch.int64),
+        segment_indices=[1],
+    )
+
+    with mock.patch("lorax_server.adapters.lora.get_tmp_tensors", return_value=(torch.empty(0), torch.empty(0))):
+        data = batched_weights.get_data(meta, LM_HEAD, prefill=prefill, prefill_head_indices=None).get(LORA)
+        data2 = batched_weights.get_data(meta, LM_HEAD, prefill=prefill, prefill_head_indices=None).get(LORA)
+
+    assert data.valid_segment_count == 1
+    assert data.adapter_weights.keys() == {1}
+    rd = data.rank_data[lora_rank]
+    if prefill:
+        assert rd.lora_a_ptr.tolist() == [weights.weights_a_ptr]
+        assert rd.lora_b_ptr.tolist() == [weights.weights_b_ptr]
+        assert rd.segment_starts.tolist() == [0]
+        assert rd.segment_ends.tolist() == [4]
+    else:
+        assert rd.lora_a_ptr.tolist() == [weights.weights_a_t_ptr]
+        assert rd.lora_b_ptr.tolist() == [weights.weights_b_t_ptr]
+        assert rd.indices.tolist() == [0, 0, 0, 0]
+
+    # the pointer tensors are only built once per adapter
+    assert data2.rank_data[lora_rank].lora_a_ptr is rd.lora_a_ptr
+
+    # an adapter without lora weights for the layer doesn't produce any batch weights
+    meta.segment_indices = [0]
+    assert batched_weights.get_data(meta, LM_HEAD, prefill=prefill, prefill_head_indices=None).get(LORA) is None
+
+
+@pytest.mark.parametrize(
+    "head_indices,expected",
+    [
+        # last token of each sequence
+        ([2, 4, 8], {8: ([0, 2], [1, 3]), 16: ([1], [2])}),
+        # every token, e.g. when prefill logprobs are requested
+        (list(range(9)), {8: ([0, 5], [3, 9]), 16: ([3], [5])}),
+    ],
+)
+def test_batched_lora_weights_prefill_head_indices(
+    head_indices: List[int], expected: Dict[int, Tuple[List[int], List[int]]]
+):
+    batched_weights = LayerAdapterWeights()
+
+    h = 1024
+    for idx, lora_rank in enumerate([8, 16]):
+        weights = LoraWeights(
+            weights_a=[torch.randn((h, lora_rank), dtype=torch.float16)],
+            weights_b=[torch.randn((lora_rank, h), dtype=torch.float16)],
+            adapter_config=LoraConfig(r=lora_rank),
+        )
+        batched_weights.add_adapter(idx, weights)
+
+    # three sequences of lengths 3, 2 and 4 using adapters 0, 1 and 0
+    meta = AdapterBatchMetadata(
+        adapter_indices=torch.tensor([0, 0, 0, 1, 1, 0, 0, 0, 0], dtype=torch.int64),
+        adapter_list=[0, 1, 0],
+        adapter_set={0, 1},
+        adapter_segments=torch.tensor([0, 3, 5, 9], dtype=torch.int32),
+        segment_indices=[0, 1, 0],
+    )
+    prefill_head_indices = torch.tensor(head_indices, dtype=torch.int64)
+
+    with mock.patch("lorax_server.adapters.lora.get_tmp_tensors", return_value=(torch.empty(0), torch.empty(0))):
+        batch_data = batched_weights.get_data(meta, LM_HEAD, prefill=True, prefill_head_indices=prefill_head_indices)
+    data = batch_data.get(LORA)
+
+    for rank, (starts, ends) in expected.items():
+        assert data.rank_data[rank].segment_starts.tolist() == starts
+        assert data.rank_data[rank].segment_ends.tolist() == ends
+    assert data.rank_data[8].segment_starts.dtype == meta.adapter_segments.dtype
+
+
+@pytest.mark.parametrize("prefill", [True, False])
+def test_batched_lora_weights_compiled_meta(prefill: bool):
+    batched_weights = LayerAdapterWeights()
+
+    h = 1024
+    for idx, lora_rank in enumerate([8, 16]):
+        weights = LoraWeights(
+            weights_a=[torch.randn((h, lora_rank), dtype=torch.float16)],
+            weights_b=[torch.randn((lora_rank, h), dtype=torch.float16)],
+            adapter_config=LoraConfig(r=lora_rank),
+        )
+        batched_weights.add_adapter(idx, weights)
+
+    meta = AdapterBatchMetadata(
+        adapter_indices=torch.tensor([0, 0, 0, 1, 1, 0, 0, 0, 0], dtype=torch.int64),
+        adapter_list=[0, 1, 0],
+        adapter_set={0, 1},
+        adapter_segments=torch.tensor([0, 3, 5, 9], dtype=torch.int64),
+        segment_indices=[0, 1, 0],
+    )
+    prefill_head_indices = torch.tensor([2, 4, 8], dtype=torch.int64) if prefill else None
+
+    data = {}
+    for compile_meta in [False, True]:
+        with (
+            mock.patch("lorax_server.adapters.lora.LORAX_COMPILE_LORA_META", compile_meta),
+            mock.patch("lorax_server.adapters.lora.get_tmp_tensors", return_value=(torch.empty(0), torch.empty(0))),
+        ):
+            data[compile_meta] = batched_weights.get_data(meta, LM_HEAD, prefill, prefill_head_indices).get(LORA)
+
+    for rank, rd in data[False].rank_data.items():
+        compiled_rd = data[True].rank_data[rank]
+        for field in ["lora_a_ptr", "lora_b_ptr", "segment_starts", "segment_ends", "indices"]:
+            expected = getattr(rd, field)
+            actual = getattr(compiled_rd, field)
+            if expected is None:
+                assert actual is None
+            else:
+                assert actual.tolist() == expected.tolist()
+
+
+@pytest.mark.parametrize("lora_rank", [8, 16])
+def test_lora_weights_transposed_cached(lora_rank: int):
+    h = 1024
+    weights = LoraWeights(
+        weights_a=[torch.randn((h, lora_rank), dtype=torch.float16)],
+        weights_b=[torch.randn((lora_rank, h), dtype=torch.float16)],
+        adapter_config=LoraConfig(r=lora_rank),
+    )
+
+    if lora_rank < MIN_RANK_CUSTOM:
+        # cutlass shrink uses a different orientation for SGMV and BGMV
+        assert weights.weights_a_t.shape == (1, lora_rank, h)
+        assert weights.weights_a_t.data_ptr() != weights.weights_a.data_ptr()
+    else:
+        # same orientation, so the weights must not be copied
+        assert weights.weights_a_t is weights.weights_a
+    assert weights.weights_b_t.shape == (1, h, lora_rank)
+
+    # switching between orientations must not rematerialize the weights
+    ptrs = (weights.weights_a.data_ptr(), weights.weights_b.data_ptr())
+    ptrs_t = (weights.weights_a_t.data_ptr(), weights.weights_b_t.data_ptr())
+    assert (weights.weights_a.data_ptr(), weights.weights_b.data_ptr()) == ptrs
+    assert (weights.weights_a_t.data_ptr(), weights.weights_b_t.data_ptr()) == ptrs_t
+    assert (weights.weights_a_ptr, weights.weights_b_ptr) == ptrs
+    assert (weights.weights_a_t_ptr, weights.weights_b_t_ptr) == ptrs_t
+
+
+@pytest.mark.parametrize("lora_rank", [8, 16])
+def test_lora_weights_packed(lora_rank: int):
+    h = 1000
+    weights_a = torch.randn((h, lora_rank), dtype=torch.float16)
+    weights_b = torch.randn((lora_rank, h), dtype=torch.float16)
+    weights = LoraWeights(weights_a=[weights_a], weights_b=[weights_b], adapter_config=LoraConfig(r=lora_rank))
+
+    # all orientations are aligned views of the same buffer
+    storage_ptr = weights._buffer.untyped_storage().data_ptr()
+    for t in (weights.weights_a, weights.weights_b, weights.weights_a_t, weights.weights_b_t):
+        assert t.is_contiguous()
+        assert t.untyped_storage().data_ptr() == storage_ptr
+        assert (t.data_ptr() - storage_ptr) % 256 == 0
+
+    assert torch.equal(weights.weights_a[0], orient_for_rank(weights_a, lora_rank))
+    assert torch.equal(weights.weights_b[0], weights_b)
+    assert torch.equal(
+        weights.weights_a_t[0], weights.weights_a[0].T if lora_rank < MIN_RANK_CUSTOM else weights.weights_a[0]
+    )
+    assert torch.equal(weights.weights_b_t[0], weights_b.T)
+
+
+@pytest.mark.parametrize("int8_cache", [True, False])
+@pytest.mark.parametrize("lora_rank", [8, 16])
+def test_lora_weights_int8_cache(int8_cache: bool, lora_rank: int):
+    h = 1024
+    with mock.patch("lorax_server.adapters.lora.LORAX_LORA_INT8_CACHE", int8_cache):
+        weights = LoraWeights(
+            weights_a=[torch.randn((h, lora_rank), dtype=torch.float16)],
+            weights_b=[torch.randn((lora_rank, h), dtype=torch.float16)],
+            adapter_config=LoraConfig(r=lora_rank),
+        )
+
+    if not int8_cache:
+        assert weights.weights_a_q8 is None
+        assert weights.weights_b_q8 is None
+        return
+
+    storage_ptr = weights._buffer.untyped_storage().data_ptr()
+    for w, (q, scale), scale_shape in (
+        (weights.weights_a_t, weights.weights_a_q8, (1, lora_rank, 1)),
+        (weights.weights_b_t, weights.weights_b_q8, (1, 1, lora_rank)),
+    ):
+        # quantized in the BGMV orientation with one scale per rank and packed with the rest of the weights
+        assert q.untyped_storage().data_ptr() == storage_ptr
+        assert scale.untyped_storage().data_ptr() == storage_ptr
+        assert q.dtype == torch.int8
+        assert q.shape == w.shape
+        assert scale.shape == scale_shape
+        assert torch.allclose(q.float() * scale.float(), w.float(), atol=scale.float().max().item())
+
+
+@pytest.mark.parametrize("lora_rank", [8, 16])
+@pytest.mark.parametrize("world_size", [1, 2])
+def test_fused_lora_weights(lora_rank: int, world_size: int):
+    h = 64
+    hidden_sizes = [64, 32, 32]
+    x = torch.randn((4, h), dtype=torch.float64)
+
+    full_a = [torch.randn((h, lora_rank), dtype=torch.float64) for _ in hidden_sizes]
+    full_b = [torch.randn((lora_rank, size), dtype=torch.float64) for size in hidden_sizes]
+
+    # column parallel sharding: A along the rank, B along the output
+    shard_rank = lora_rank // world_size
+    fused_shards = []
+    for shard in range(world_size):
+        shard_weights = [
+            LoraWeights(
+                weights_a=[a[:, shard * shard_rank : (shard + 1) * shard_rank]],
+                weights_b=[b[:, shard * b.size(1) // world_size : (shard + 1) * b.size(1) // world_size]],
+                adapter_config=LoraConfig(r=lora_rank),
+            )
+            for a, b in zip(full_a, full_b)
+        ]
+        fused = FusedLoraWeights.fuse(shard_weights)
+        assert fused is not None
+        assert fused.lora_a_r == 1 << (3 * shard_rank - 1).bit_length()
+        assert fused.lora_b_r == world_size * fused.lora_a_r
+        fused_shards.append(fused)
+
+    # all-gather X @ A across shards, then multiply by the local B
+    a_out = torch.cat([x @ orient_for_rank(f.weights_a[0], f.lora_a_r) for f in fused_shards], dim=1)
+    for shard, fused in enumerate(fused_shards):
+        expected = torch.cat(
+            [
+                (x @ a @ b)[:, shard * b.size(1) // world_size : (shard + 1) * b.size(1) // world_size]
+                for a, b in zip(full_a, full_b)
+            ],
+            dim=1,
+        )
+        assert torch.allclose(a_out @ fused.weights_b[0], expected)
+
+
+def test_fused_lora_weights_mismatched_ranks():
+    h = 64
+    weights = [
+        LoraWeights(
+            weights_a=[torch.randn((h, lora_rank), dtype=torch.float16)],
+            weights_b=[torch.randn((lora_rank, h), dtype=torch.float16)],
+            adapter_config=LoraConfig(r=lora_rank),
+        )
+        for lora_rank in [8, 16, 8]
+    ]
+    assert FusedLoraWeights.fuse(weights) is None
+
+
+@pytest.mark.parametrize("int8_cache", [True, False])
+@pytest.mark.parametrize("hidden_sizes", [[1024, 256, 256], [1024, 2048, 2048]])
+@pytest.mark.parametrize("lora_rank", [1, 3, 8, 11, 16, 22, 42])
+def test_fused_lora_weights_size_bound(int8_cache: bool, hidden_sizes: List[int], lora_rank: int):
+    h = 1024
+    weights_a = [torch.randn((h, lora_rank), dtype=torch.float16) for _ in hidden_sizes]
+    weights_b = [torch.randn((lora_rank, size), dtype=torch.float16) for size in hidden_sizes]
+    with mock.patch("lorax_server.adapters.lora.LORAX_LORA_INT8_CACHE", int8_cache):
+        weights = [
+            LoraWeights(weights_a=[a], weights_b=[b], adapter_config=LoraConfig(r=lora_rank))
+            for a, b in zip(weights_a, weights_b)
+        ]
+        fused = FusedLoraWeights.fuse(weights)
+    assert fused is not None
+
+    # the unfused and the packed weights are both resident while the adapter is loaded
+    disk_bytes = sum(t.numel() * t.element_size() for t in weights_a + weights_b)
+    resident_bytes = sum(w._buffer.numel() for w in weights) + fused._buffer.numel()
+    resident_size_factor = 2.5 if int8_cache else 2.0
+    assert resident_bytes <= resident_size_factor * (1 + FUSED_QKV_SIZE_FACTOR) * disk_bytes
+
+
+class FakeProcessGroup:
+    def size(self) -> int:
+        return 1
+
+
+@pytest.mark.parametrize(
+    "layer_names,expected_layer_types",
+    [
+        ([Q_PROJ, K_PROJ, V_PROJ], [QKV_PROJ_FUSED, Q_PROJ, K_PROJ, V_PROJ]),
+        # e.g. cross attention, where q, k and v are separate linears
+        ([Q_PROJ], [Q_PROJ]),
+    ],
+)
+def test_multi_adapter_linear_fused_qkv_dispatch(layer_names: List[str], expected_layer_types: List[str]):
+    h = 4
+    sizes = [h] * len(layer_names)
+    layer = TensorParallelMultiAdapterLinear(
+        torch.nn.Linear(h, sum(sizes)), 0, layer_names, sizes, process_group=FakeProcessGroup()
+    )
+    adapter_data = mock.Mock(data={QKV_PROJ_FUSED: {}})
+
+    with mock.patch.object(
+        TensorParallelMultiAdapterLinear,
+        "forward_layer_type",
+        autospec=True,
+        side_effect=lambda self, result, *args: result,
+    ) as forward_layer_type:
+        layer(torch.randn((2, h)), adapter_data)
+
+    layer_types = [call.args[4] for call in forward_layer_type.call_args_list]
+    assert layer_types == expected_layer_types
+    if layer_types[0] == QKV_PROJ_FUSED:
+        # the packed adapter covers the whole output
+        assert forward_layer_type.call_args_list[0].args[5:] == (0, sum(sizes))
+
+
+def _make_meta() -> AdapterBatchMetadata:
+    return AdapterBatchMetadata(
+        adapter_indices=torch.tensor([0], dtype=torch.int64),
+        adapter_list=[0],
+        adapter_set={0},
+        adapter_segments=torch.tensor([0, 1], dtype=torch.int64),
+        segment_indices=[0],
+    )
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA not available")
+def test_ptr_staging_ring():
+    device = torch.device("cuda")
+    ring = PtrStagingRing(device, size=2, capacity=8)
+    meta = _make_meta()
+
+    # layers of one step are bump allocated from the same slot
+    q = ring.to_device(np.arange(3, dtype=np.int64), meta, Q_PROJ)
+    v = ring.to_device(np.arange(3, 6, dtype=np.int64), meta, V_PROJ)
+    assert ring.slot == 1
+    assert v.data_ptr() == q.data_ptr() + 3 * q.element_size()
+
+    # decode steps reuse the metadata, so preparing a layer again starts a new step in the next slot
+    q_next = ring.to_device(np.arange(6, 9, dtype=np.int64), meta, Q_PROJ)
+    assert ring.slot == 0
+    assert q.tolist() == [0, 1, 2]
+    assert v.tolist() == [3, 4, 5]
+    assert q_next.tolist() == [6, 7, 8]
+
+    # after `size` steps the buffers of the first step are reused
+    q_reused = ring.to_device(np.arange(3, dtype=np.int64), _make_meta(), Q_PROJ)
+    assert ring.slot == 1
+    assert q_reused.data_ptr() == q.data_ptr()
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA not available")
+def test_ptr_staging_ring_capacity_fallback():
+    device = torch.device("cuda")
+    ring = PtrStagingRing(device, size=2, capacity=8)
+    meta = _make_meta()
+    ptrs = np.arange(16, dtype=np.int64)
+
+    assert ring.to_device(ptrs, meta, Q_PROJ) is None
+
+    with mock.patch("lorax_server.adapters.lora.get_ptr_staging_ring", return_value=ring):
+        ptrs_d = _ptrs_to_device(ptrs, device, meta, Q_PROJ)
+    assert ptrs_d.device.type == "cuda"
+    assert ptrs_d.tolist() == ptrs.tolist()
+
+
+class FakeModelSource(BaseModelSource):
+    def __init__(self, paths):
+        self.paths = paths
+
+    def weight_files(self, extension: str = None):
+        return self.paths
+
+
+def test_adapter_resident_bytes(tmp_path):
+    lora_weights = {
+        "base_model.model.layers.0.self_attn.q_proj.lora_A.weight": torch.zeros((8, 64), dtype=torch.float16),
+        "base_model.model.layers.0.self_attn.q_proj.lora_B.weight": torch.zeros((64, 8), dtype=torch.float16),
+    }
+    medusa_weights = {"medusa_head.0.0.linear.weight": torch.zeros((64, 64), dtype=torch.float16)}
+    lora_bytes = 2 * 8 * 64 * 2
+    medusa_bytes = 64 * 64 * 2
+
+    lora_path = tmp_path / "lora.safetensors"
+    save_file(lora_weights, str(lora_path))
+    medusa_lora_path = tmp_path / "medusa_lora.safetensors"
+    save_file({**lora_weights, **medusa_weights}, str(medusa_lora_path))
+    medusa_path = tmp_path / "medusa.safetensors"
+    save_file(medusa_weights, str(medusa_path))
+
+    lora_config = LoraAdapterConfig(
+        base_model_name_or_path="", r=8, target_modules=None, fan_in_fan_out=False, lora_alpha=8, use_rslora=False
+    )
+    medusa_config = MedusaConfig(base_model_name_or_path="", medusa_num_heads=1, medusa_num_layers=1, version=1)
+    medusa_lora_config = MedusaLoraConfig(
+        base_model_name_or_path="", lora_config=lora_config, medusa_config=medusa_config
+    )
+
+    # only the LoRA weights are kept in more than one layout
+    assert lora_config.get_resident_bytes(FakeModelSource([lora_path])) == int(lora_bytes * LORA_RESIDENT_SIZE_FACTOR)
+    assert medusa_config.get_resident_bytes(FakeModelSource([medusa_path])) == medusa_bytes
+    assert medusa_lora_config.get_resident_bytes(FakeModelSource([medusa_lora_path])) == medusa_bytes + int(
+        lora_bytes * LORA_RESIDENT_SIZE_FACTOR
+    )